@@ -1,98 +1,84 @@
 import argparse
+import functools
+import itertools
 import json
+import multiprocessing
+import os
+import queue
+import shutil
 import sys
+import threading
 import time
 import uuid
 from pathlib import Path
 
+try:  # optional fast JSON encoder for the log
+    import orjson
+except ImportError:
+    orjson = None
+
 from .core import (
     APPLE_CAMERA_EXTS,
+    DigestCache,
+    _fold_name,
+    _has_suffix,
     b64url_no_pad,
     digest_blake3,
     find_noncolliding_strip_dst,
-    iter_files,
+    iter_digests,
+    iter_entries,
     parse_suffix,
     propose_dst_apply,
+    rename_noreplace,
     same_bytes,
     verify_suffix_matches_digest,
 )
 
 
-def main(argv=None) -> int:
-    ap = argparse.ArgumentParser(
-        description=(
-            "Rename camera-like files by appending/removing short base64url(BLAKE3) suffix "
-            "(idempotent; collision-safe)."
-        )
-    )
-    ap.add_argument("root", type=Path, help="Root directory to scan.")
-    ap.add_argument("--chars", type=int, default=6, help="Base suffix length in base64url chars (default: 6).")
+# Entries pulled from the directory walk per filtering pass; bounds memory on huge trees.
+_SCAN_BATCH = 4096
 
-    # Modes
-    ap.add_argument("--apply", action="store_true", help="Actually rename files. Default is dry-run.")
-    ap.add_argument("--strip", action="store_true", help="Strip suffix instead of appending it.")
 
-    # Extension selection
-    ap.add_argument("--preset", choices=["apple-camera"], default=None, help="Use a predefined extension set.")
-    ap.add_argument("--ext", action="append", default=None, help="Extensions to include (repeatable), e.g. --ext .heic --ext .jpg")
+def _jsonl(rec: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(rec, option=orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(rec, ensure_ascii=False) + "\n").encode("utf-8")
 
-    # Strip options
-    ap.add_argument(
-        "--no-verify",
-        dest="verify",
-        action="store_false",
-        help="When stripping, do not verify suffix against file digest (faster, less safe).",
-    )
-    ap.set_defaults(verify=True)
-    ap.add_argument(
-        "--conflict",
-        choices=["refuse", "keep-suffixed", "add-counter"],
-        default="refuse",
-        help="When stripping, what to do if the stripped target exists with different content (default: refuse).",
-    )
-
-    # Output / progress
-    ap.add_argument("-v", "--verbose", action="store_true", help="Print each rename as it is found.")
-    ap.add_argument("-q", "--quiet", action="store_true", help="Suppress non-error output (overrides --verbose/progress).")
-    ap.add_argument(
-        "--progress",
-        type=int,
-        default=0,
-        metavar="N",
-        help="If set, print progress every N files scanned (to stderr).",
-    )
 
-    # Logging (apply mode only)
-    ap.add_argument("--log", type=Path, default=None, help="JSONL log path (default: <root>/rename-log.jsonl when --apply).")
+def _hash_entry(entry, cache=None) -> bytes:
+    # Small sidecars (.aae/.xmp/.json) get their concurrency from the iter_digests pool; the
+    # cached DirEntry stat doubles as the size hint (and cache key) and is reused later for the log record.
+    if cache is not None:
+        return cache.cached_digest(Path(entry.path), entry.stat())
+    return digest_blake3(Path(entry.path), size=entry.stat().st_size)
 
-    args = ap.parse_args(argv)
-
-    root = args.root.resolve()
 
-    run_id = str(uuid.uuid4())
+def _rename_worker(rename_q: "queue.Queue", logf, errors: list, taken: list) -> None:
+    # Consumes (old, new, rec) jobs until a None sentinel; after a failure, only drains the queue.
+    # A target that turned out to exist (e.g. a case-insensitive name match the name set missed)
+    # is recorded in `taken` and skipped rather than stopping the run.
+    while True:
+        job = rename_q.get()
+        if job is None:
+            return
+        if errors:
+            continue
+        old, new, rec = job
+        try:
+            rename_noreplace(old, new)
+            if rec is not None:
+                logf.write(_jsonl(rec))
+        except FileExistsError:
+            taken.append((old, new))
+        except BaseException as e:
+            errors.append(e)
 
-    # Extension set
-    if args.ext is not None:
-        ext_filter = set()
-        for e in args.ext:
-            e = e.strip()
-            if not e:
-                continue
-            if not e.startswith("."):
-                e = "." + e
-            ext_filter.add(e.lower())
-    elif args.preset == "apple-camera":
-        ext_filter = set(APPLE_CAMERA_EXTS)
-    else:
-        ext_filter = {".heic"}  # historical default
 
-    # Logging
-    logf = None
-    log_path = None
+def _process(args, root: Path, entries, ext_filter: set, jobs: int, run_id: str, logf) -> dict:
+    """Run the per-file loop over `entries` (os.DirEntry for files under root) and return the counters."""
     exts_used = sorted(ext_filter)  # ext_filter already lowercased
-    if args.apply:
-        log_path = args.log or (root / "rename-log.jsonl")
-        logf = log_path.open("a", encoding="utf-8")
+    # str.endswith(tuple) runs in C; listing upper-case variants avoids lowercasing typical camera names.
+    ext_tuple = tuple(exts_used) + tuple(e.upper() for e in exts_used)
 
     scanned = 0
     considered = 0
@@ -102,13 +88,40 @@ def main(argv=None) -> int:
     skipped_verify_fail = 0
     conflicts = 0
 
-    t0 = time.time()
+    # Apply-mode renames and log writes run on one worker thread so hashing can move on.
+    # (Strip mode stays inline: its collision checks must see every earlier rename.)
+    rename_q = None
+    rename_thread = None
+    rename_errors = []
+    rename_taken = []
+    if args.apply and not args.strip:
+        rename_q = queue.Queue(maxsize=256)
+        rename_thread = threading.Thread(
+            target=_rename_worker, args=(rename_q, logf, rename_errors, rename_taken), daemon=True
+        )
+        rename_thread.start()
 
-    try:
-        for p in iter_files(root):
-            scanned += 1
+    names_dir = None
+    dir_names = None
 
-            if args.progress and (not args.quiet) and scanned % args.progress == 0:
+    # Opened here rather than in main() so each --procs worker gets its own connection.
+    cache = DigestCache(args.cache) if args.cache else None
+
+    t0 = time.time()
+
+    def targets():
+        # Cheap filtering on the main thread; yields (entry, needs_digest) for hashing.
+        # Entries are taken in batches and filtered on names alone before any per-file work.
+        nonlocal scanned, considered, skipped_not_target
+        it = iter(entries)
+        while True:
+            batch = list(itertools.islice(it, _SCAN_BATCH))
+            if not batch:
+                return
+
+            prev_scanned = scanned
+            scanned += len(batch)
+            if args.progress and (not args.quiet) and scanned // args.progress != prev_scanned // args.progress:
                 dt = max(1e-9, time.time() - t0)
                 rate = scanned / dt
                 print(
@@ -118,19 +131,41 @@ def main(argv=None) -> int:
                     file=sys.stderr,
                 )
 
-            if not p.is_file():
-                continue
+            names = [e.name for e in batch]
+            mask = [n.endswith(ext_tuple) or n.lower().endswith(ext_tuple) for n in names]
+            skipped_not_target += mask.count(False)
 
-            if p.suffix.lower() not in ext_filter:
-                skipped_not_target += 1
-                continue
+            for entry, name, hit in zip(batch, names, mask):
+                if not hit:
+                    continue
+                stem, ext = os.path.splitext(name)
+                if not ext:  # dotfile named like the extension itself, e.g. ".heic"
+                    skipped_not_target += 1
+                    continue
+
+                considered += 1
 
-            considered += 1
+                if not args.strip:
+                    yield entry, not _has_suffix(stem)
+                else:
+                    yield entry, args.verify and parse_suffix(stem) is not None
 
+    try:
+        for entry, digest in iter_digests(targets(), jobs, functools.partial(_hash_entry, cache=cache)):
             if not args.strip:
                 # APPLY MODE
-                digest = digest_blake3(p)
-                dst, sfx = propose_dst_apply(p, digest, args.chars)
+                if digest is None:
+                    # already suffixed; not hashed (nor wrapped in a Path: on a resumed run this is most files)
+                    skipped_dupe_or_already += 1
+                    continue
+                p = Path(entry.path)
+                # iter_entries yields each directory's files contiguously, so one listing
+                # per directory replaces a stat per candidate name. Names are folded so a
+                # case/normalization variant on APFS still goes through the stat + same_bytes check.
+                parent = os.path.dirname(entry.path)
+                if parent != names_dir:
+                    names_dir, dir_names = parent, {_fold_name(n) for n in os.listdir(parent)}
+                dst, sfx = propose_dst_apply(p, digest, args.chars, entry.stat(), dir_names)
                 if dst is None:
                     skipped_dupe_or_already += 1
                     continue
@@ -139,11 +174,12 @@ def main(argv=None) -> int:
                     print(f"{p}  ->  {dst}")
 
                 if args.apply:
-                    p.rename(dst)
-                    renamed += 1
+                    st = entry.stat()  # taken before the rename; size/mtime are unchanged by it
+                    p_str = entry.path
+                    dst_str = os.fspath(dst)
 
+                    rec = None
                     if logf:
-                        st = dst.stat() if args.apply else p.stat()
                         rec = {
                             "ts": int(time.time()),
                             "run_id": run_id,
@@ -155,21 +191,29 @@ def main(argv=None) -> int:
                             "exts": exts_used,
                             "verify": False,
                             "conflict_policy": None,
-                            "old": str(p),
-                            "new": str(dst),
+                            "old": p_str,
+                            "new": dst_str,
                             "suffix_used": sfx,
                             "suffix_removed": None,
                             "blake3_b64url": b64url_no_pad(digest),
                             "size": st.st_size,
                             "mtime": int(st.st_mtime),
                         }
-                        logf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+                    if rename_errors:
+                        raise rename_errors[0]
+                    rename_q.put((p_str, dst_str, rec))
+                    renamed += 1
+                    # Track the queued rename so later proposals in this directory see it.
+                    dir_names.discard(_fold_name(entry.name))
+                    dir_names.add(_fold_name(dst.name))
 
                 else:
                     renamed += 1
 
             else:
                 # STRIP MODE
+                p = Path(entry.path)
                 parsed = parse_suffix(p.stem)
                 if not parsed:
                     skipped_dupe_or_already += 1
@@ -177,16 +221,19 @@ def main(argv=None) -> int:
                 base_stem, suffix = parsed
 
                 if args.verify:
-                    digest = digest_blake3(p)
                     if not verify_suffix_matches_digest(suffix, digest, args.chars):
                         skipped_verify_fail += 1
                         continue
 
                 dst = p.with_name(f"{base_stem}{p.suffix}")
 
-                # Collision handling
-                if dst.exists():
-                    if same_bytes(p, dst):
+                # Collision handling (one stat of dst doubles as the existence check)
+                try:
+                    dst_stat = dst.stat()
+                except FileNotFoundError:
+                    dst_stat = None
+                if dst_stat is not None:
+                    if same_bytes(p, dst, digest, entry.stat(), dst_stat):
                         # already stripped / duplicate; treat as skip
                         skipped_dupe_or_already += 1
                         continue
@@ -212,34 +259,222 @@ def main(argv=None) -> int:
                     print(f"{p}  ->  {dst}")
 
                 if args.apply:
-                    p.rename(dst)
+                    st = entry.stat()  # taken before the rename; size/mtime are unchanged by it
+                    p_str = entry.path
+                    dst_str = os.fspath(dst)
+                    # dst was found free (or chosen free) just above; unlike the queued apply-mode
+                    # renames, there is no gap to re-check.
+                    os.rename(p_str, dst_str)
                     renamed += 1
                     if logf:
                         rec = {
                             "mode": "strip",
-                            "old": str(p),
-                            "new": str(dst),
+                            "old": p_str,
+                            "new": dst_str,
                             "verify": bool(args.verify),
                             "suffix_removed": suffix,
-                            "size": dst.stat().st_size,
-                            "mtime": int(dst.stat().st_mtime),
+                            "size": st.st_size,
+                            "mtime": int(st.st_mtime),
                         }
-                        logf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                        logf.write(_jsonl(rec))
                 else:
                     renamed += 1
 
+    finally:
+        if rename_thread is not None:
+            rename_q.put(None)
+            rename_thread.join()
+        if cache is not None:
+            cache.close()
+
+    if rename_errors:
+        raise rename_errors[0]
+
+    # Queued renames were counted optimistically; targets found to exist are conflicts instead.
+    for old, new in rename_taken:
+        renamed -= 1
+        conflicts += 1
+        if not args.quiet:
+            print(f"[conflict] target exists: {new} (from {old})", file=sys.stderr)
+
+    return {
+        "scanned": scanned,
+        "considered": considered,
+        "renamed": renamed,
+        "skipped_not_target": skipped_not_target,
+        "skipped_dupe_or_already": skipped_dupe_or_already,
+        "skipped_verify_fail": skipped_verify_fail,
+        "conflicts": conflicts,
+    }
+
+
+def _process_subtrees(args, root: Path, dirs: list, ext_filter: set, jobs: int, run_id: str, log_part) -> dict:
+    # --procs worker: runs _process over some top-level subdirectories, logging to its own file.
+    logf = log_part.open("ab", buffering=1 << 20) if log_part is not None else None
+    try:
+        entries = itertools.chain.from_iterable(iter_entries(d, jobs) for d in dirs)
+        return _process(args, root, entries, ext_filter, jobs, run_id, logf)
+    finally:
+        if logf:
+            logf.close()
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(
+        description=(
+            "Rename camera-like files by appending/removing short base64url(BLAKE3) suffix "
+            "(idempotent; collision-safe)."
+        )
+    )
+    ap.add_argument("root", type=Path, help="Root directory to scan.")
+    ap.add_argument("--chars", type=int, default=6, help="Base suffix length in base64url chars (default: 6).")
+
+    # Modes
+    ap.add_argument("--apply", action="store_true", help="Actually rename files. Default is dry-run.")
+    ap.add_argument("--strip", action="store_true", help="Strip suffix instead of appending it.")
+
+    # Extension selection
+    ap.add_argument("--preset", choices=["apple-camera"], default=None, help="Use a predefined extension set.")
+    ap.add_argument("--ext", action="append", default=None, help="Extensions to include (repeatable), e.g. --ext .heic --ext .jpg")
+
+    # Strip options
+    ap.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help="When stripping, do not verify suffix against file digest (faster, less safe).",
+    )
+    ap.set_defaults(verify=True)
+    ap.add_argument(
+        "--conflict",
+        choices=["refuse", "keep-suffixed", "add-counter"],
+        default="refuse",
+        help="When stripping, what to do if the stripped target exists with different content (default: refuse).",
+    )
+
+    # Performance
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Number of files to hash, and directories to list, in parallel (default: CPU count; 1 disables the thread pools).",
+    )
+    ap.add_argument(
+        "--procs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Split top-level subdirectories across N worker processes (default: 1; --jobs then defaults to CPU count / N).",
+    )
+
+    ap.add_argument(
+        "--cache",
+        type=Path,
+        default=None,
+        metavar="PATH",
+        help="SQLite digest cache, keyed by device/inode/mtime/size; unchanged files are not re-hashed on later runs.",
+    )
+
+    # Output / progress
+    ap.add_argument("-v", "--verbose", action="store_true", help="Print each rename as it is found.")
+    ap.add_argument("-q", "--quiet", action="store_true", help="Suppress non-error output (overrides --verbose/progress).")
+    ap.add_argument(
+        "--progress",
+        type=int,
+        default=0,
+        metavar="N",
+        help="If set, print progress about every N files scanned (at most once per scan batch; to stderr).",
+    )
+
+    # Logging (apply mode only)
+    ap.add_argument("--log", type=Path, default=None, help="JSONL log path (default: <root>/rename-log.jsonl when --apply).")
+
+    args = ap.parse_args(argv)
+
+    root = args.root.resolve()
+    procs = max(1, args.procs)
+    jobs = args.jobs if args.jobs is not None else max(1, (os.cpu_count() or 1) // procs)
+
+    run_id = str(uuid.uuid4())
+
+    # Extension set
+    if args.ext is not None:
+        ext_filter = set()
+        for e in args.ext:
+            e = e.strip()
+            if not e:
+                continue
+            if not e.startswith("."):
+                e = "." + e
+            ext_filter.add(e.lower())
+    elif args.preset == "apple-camera":
+        ext_filter = set(APPLE_CAMERA_EXTS)
+    else:
+        ext_filter = {".heic"}  # historical default
+
+    # Logging
+    logf = None
+    log_path = None
+    log_parts = []
+    if args.apply:
+        log_path = args.log or (root / "rename-log.jsonl")
+        logf = log_path.open("ab", buffering=1 << 20)
+
+    try:
+        if procs == 1:
+            stats = _process(args, root, iter_entries(root, jobs), ext_filter, jobs, run_id, logf)
+        else:
+            # Renames never leave their directory, so top-level subtrees are independent:
+            # workers take them round-robin while this process handles files directly in root.
+            with os.scandir(root) as it:
+                top = list(it)
+            dirs = [e.path for e in top if e.is_dir(follow_symlinks=False)]
+            files = [e for e in top if e.is_file(follow_symlinks=False)]
+            groups = [dirs[i::procs] for i in range(min(procs, len(dirs)))]
+            if log_path is not None:
+                log_parts = [
+                    log_path.with_name(f"{log_path.stem}.{os.getpid()}-{i}{log_path.suffix}") for i in range(len(groups))
+                ]
+            pool = multiprocessing.Pool(max(1, len(groups)))
+            try:
+                pending = pool.starmap_async(
+                    _process_subtrees,
+                    [
+                        (args, root, g, ext_filter, jobs, run_id, log_parts[i] if log_parts else None)
+                        for i, g in enumerate(groups)
+                    ],
+                )
+                stats = _process(args, root, files, ext_filter, jobs, run_id, logf)
+                for sub in pending.get():
+                    for k, v in sub.items():
+                        stats[k] += v
+            finally:
+                # Let workers finish rather than killing them between a rename and its log record.
+                pool.close()
+                pool.join()
+
     finally:
         if logf:
+            # Fold per-worker logs into the main log, even after a failure, so no record is lost.
+            for part in log_parts:
+                if part.exists():
+                    with part.open("rb") as pf:
+                        shutil.copyfileobj(pf, logf)
+                    part.unlink()
+            logf.flush()
             logf.close()
 
     if not args.quiet:
         mode = "STRIP" if args.strip else "APPLY"
         applied = "APPLIED" if args.apply else "DRY-RUN"
         print(
-            f"{mode} {applied}: scanned={scanned} considered={considered} "
-            f"{'renamed' if args.apply else 'would_rename'}={renamed} "
-            f"skipped_not_target={skipped_not_target} skipped_dupe_or_already={skipped_dupe_or_already} "
-            f"skipped_verify_fail={skipped_verify_fail} conflicts={conflicts}"
+            f"{mode} {applied}: scanned={stats['scanned']} considered={stats['considered']} "
+            f"{'renamed' if args.apply else 'would_rename'}={stats['renamed']} "
+            f"skipped_not_target={stats['skipped_not_target']} "
+            f"skipped_dupe_or_already={stats['skipped_dupe_or_already']} "
+            f"skipped_verify_fail={stats['skipped_verify_fail']} conflicts={stats['conflicts']}"
         )
         if args.apply and log_path is not None:
             print(f"Log: {log_path}")
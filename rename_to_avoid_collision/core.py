@@ -1,14 +1,28 @@
 import base64
-import hashlib
+import errno
+import io
+import mmap
 import os
 import re
+import sqlite3
+import string
+import threading
+import unicodedata
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import AbstractSet, Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
 
 from blake3 import blake3
 
+try:  # optional SIMD base64 codec
+    from pybase64 import urlsafe_b64encode as _urlsafe_b64encode
+except ImportError:
+    _urlsafe_b64encode = base64.urlsafe_b64encode
+
 # Matches "NAME__suffix" where suffix is base64url-ish (no padding), >= 4 chars
 SUFFIX_RE = re.compile(r"^(?P<stem>.*)__([A-Za-z0-9_-]{4,})$")
+_SUFFIX_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
 
 APPLE_CAMERA_EXTS = {
     ".heic", ".heif",
@@ -21,75 +35,442 @@ APPLE_CAMERA_EXTS = {
 
 
 def b64url_no_pad(b: bytes) -> str:
-    return base64.urlsafe_b64encode(b).decode("ascii").rstrip("=")
+    return _urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+
+# Files at least this large are hashed via mmap with BLAKE3's multithreaded tree hashing;
+# below it, threading has no benefit.
+MT_HASH_MIN_SIZE = 1 << 20
+# Older blake3 wheels lack update_mmap; large files then take the mmap.mmap path below.
+_HAS_UPDATE_MMAP = hasattr(blake3, "update_mmap")
+# Files at least this large (but below MT_HASH_MIN_SIZE) are hashed from a read-only mmap
+# instead of the read loop; for tiny files the mapping costs more than the copy it saves.
+MMAP_HASH_MIN_SIZE = 64 * 1024
+# Default read size for the remaining (small-file) read loop; small enough to stay in L2.
+HASH_CHUNK_SIZE = 256 * 1024
+
+
+def _fadvise(fd: int, *names: str) -> None:
+    # Best-effort whole-file page-cache hints, given as os.POSIX_FADV_* names;
+    # a no-op where posix_fadvise is unavailable (e.g. Windows, macOS).
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for name in names:
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, name))
+        except OSError:
+            return
+
+
+# On Windows, O_SEQUENTIAL maps to FILE_FLAG_SEQUENTIAL_SCAN; elsewhere it is absent (0).
+_O_SEQUENTIAL = getattr(os, "O_SEQUENTIAL", 0)
+
+
+def _open_sequential(file_path: Path, prefetch: bool = True) -> io.FileIO:
+    """
+    Open file_path for a front-to-back read, hinting the OS to read ahead aggressively.
+    prefetch also queues the whole file for reading (WILLNEED); leave it off when the read
+    may stop early. Unbuffered: our reads are large, so a BufferedReader would only add a copy.
+    """
+    f = open(file_path, "rb", buffering=0, opener=lambda path, flags: os.open(path, flags | _O_SEQUENTIAL))
+    if prefetch:
+        _fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL", "POSIX_FADV_WILLNEED")
+    else:
+        _fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
+    return f
+
 
+def digest_blake3(file_path: Path, chunk_size: Optional[int] = None, size: Optional[int] = None) -> bytes:
+    """
+    BLAKE3 digest (32 bytes) of a file. `size` is an optional hint (e.g. from a cached
+    os.DirEntry.stat()) used to pick the hashing strategy without another stat call.
+    chunk_size defaults to HASH_CHUNK_SIZE.
+    """
+    if size is None:
+        size = file_path.stat().st_size
+    if chunk_size is None:
+        chunk_size = HASH_CHUNK_SIZE
+    if size >= MT_HASH_MIN_SIZE and _HAS_UPDATE_MMAP:
+        return blake3(max_threads=blake3.AUTO).update_mmap(str(file_path)).digest()
 
-def digest_blake3(file_path: Path, chunk_size: int = 8 * 1024 * 1024) -> bytes:
     h = blake3()
-    with file_path.open("rb") as f:
+    with _open_sequential(file_path) as f:
+        if size >= MMAP_HASH_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(mm)
+            return h.digest()
+        # One buffer for the whole file, sized to it so small files don't pay for zeroing chunk_size bytes.
+        buf = bytearray(max(1, min(chunk_size, size + 1)))
+        mv = memoryview(buf)
         while True:
-            chunk = f.read(chunk_size)
-            if not chunk:
+            n = f.readinto(buf)
+            if not n:
                 break
-            h.update(chunk)
+            h.update(mv[:n])
+        # Media files are rarely re-read; don't let them crowd out the page cache.
+        _fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
     return h.digest()  # 32 bytes
 
 
+def _i64(x: int) -> int:
+    # SQLite integers are signed 64-bit; some filesystems report st_ino/st_dev above 2**63.
+    return x - (1 << 64) if x >= (1 << 63) else x
+
+
+class DigestCache:
+    """
+    Persistent BLAKE3 digest cache in an SQLite database, keyed by (st_dev, st_ino,
+    st_mtime_ns, st_size): a file that has not changed (or was only renamed) is not
+    re-read on later runs. Safe to share between threads; use one instance per process.
+    Stats without a file identity (st_ino == 0, as from os.DirEntry.stat() on Windows)
+    are never looked up or stored.
+    """
+
+    # New digests are buffered in memory and written in one short transaction per batch, so
+    # the database write lock (shared with other --procs workers) is never held while hashing.
+    COMMIT_EVERY = 256
+
+    def __init__(self, db_path: Path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.fspath(db_path), timeout=60, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS digests ("
+            "dev INTEGER NOT NULL, ino INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, "
+            "blake3 BLOB NOT NULL, PRIMARY KEY (dev, ino, mtime_ns, size)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        self._pending = {}
+
+    @staticmethod
+    def _key(st: os.stat_result) -> Tuple[int, int, int, int]:
+        return (_i64(st.st_dev), _i64(st.st_ino), st.st_mtime_ns, st.st_size)
+
+    def get(self, st: os.stat_result) -> Optional[bytes]:
+        if not st.st_ino:
+            return None
+        key = self._key(st)
+        with self._lock:
+            digest = self._pending.get(key)
+            if digest is not None:
+                return digest
+            row = self._db.execute(
+                "SELECT blake3 FROM digests WHERE dev=? AND ino=? AND mtime_ns=? AND size=?", key
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def put(self, st: os.stat_result, digest: bytes) -> None:
+        if not st.st_ino:
+            return
+        with self._lock:
+            self._pending[self._key(st)] = digest
+            if len(self._pending) >= self.COMMIT_EVERY:
+                self._flush()
+
+    def _flush(self) -> None:
+        # Caller holds self._lock.
+        if not self._pending:
+            return
+        self._db.executemany(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)", [k + (d,) for k, d in self._pending.items()]
+        )
+        self._db.commit()
+        self._pending.clear()
+
+    def cached_digest(self, file_path: Path, st: Optional[os.stat_result] = None) -> bytes:
+        """digest_blake3(file_path), hashing only on a cache miss. `st` may be a cached stat of file_path."""
+        if st is None or not st.st_ino:
+            st = os.stat(file_path)  # DirEntry.stat() on Windows reports st_ino/st_dev as 0
+        digest = self.get(st)
+        if digest is None:
+            digest = digest_blake3(file_path, size=st.st_size)
+            self.put(st, digest)
+        return digest
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+    def __enter__(self) -> "DigestCache":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+# Size of the head/tail blocks compared directly by same_bytes before a full comparison.
+QUICK_CMP_BLOCK = 4096
+# Block size for same_bytes' lockstep comparison when no digest is known.
+SAME_BYTES_BLOCK = 64 * 1024
+
+
 def suffix_from_digest(digest: bytes, n_chars: int) -> str:
-    # Need enough bytes to yield at least n_chars base64url characters:
-    # base64 chars = 4*ceil(n_bytes/3)  =>  n_bytes = ceil(3*n_chars/4)
-    n_bytes = (3 * n_chars + 3) // 4
-    s = b64url_no_pad(digest[:n_bytes])
-    return s[:n_chars]
+    # Base64 is prefix-stable: the first n chars of the full encoding only depend on
+    # the first ceil(3n/4) bytes, so slicing the full encoding is equivalent.
+    return b64url_no_pad(digest)[:n_chars]
 
 
-def sha256_digest(file_path: Path, chunk_size: int = 8 * 1024 * 1024) -> bytes:
-    h = hashlib.sha256()
-    with file_path.open("rb") as f:
-        for chunk in iter(lambda: f.read(chunk_size), b""):
-            h.update(chunk)
-    return h.digest()
+def _quick_unequal(a: Path, b: Path, size: int) -> bool:
+    """True if a and b (both `size` bytes long) differ in their first or last block."""
+    with a.open("rb") as fa, b.open("rb") as fb:
+        if fa.read(QUICK_CMP_BLOCK) != fb.read(QUICK_CMP_BLOCK):
+            return True
+        if size > QUICK_CMP_BLOCK:
+            tail = max(QUICK_CMP_BLOCK, size - QUICK_CMP_BLOCK)
+            fa.seek(tail)
+            fb.seek(tail)
+            return fa.read(QUICK_CMP_BLOCK) != fb.read(QUICK_CMP_BLOCK)
+    return False
 
 
-def same_bytes(a: Path, b: Path) -> bool:
-    sa = a.stat()
-    sb = b.stat()
+def _read_block(f: io.FileIO, n: int) -> bytes:
+    """Read n bytes from f, or fewer only at EOF; an unbuffered read may come up short
+    before EOF (e.g. NFS/SMB/FUSE, or after a signal)."""
+    data = f.read(n)
+    while 0 < len(data) < n:
+        more = f.read(n - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
+def same_bytes(
+    a: Path,
+    b: Path,
+    a_digest: Optional[bytes] = None,
+    a_stat: Optional[os.stat_result] = None,
+    b_stat: Optional[os.stat_result] = None,
+) -> bool:
+    """
+    True if a and b have identical content. The first and last blocks are compared directly;
+    beyond that, if a_digest (BLAKE3 of a) is known only b is hashed, otherwise both files are
+    read in lockstep and compared block by block, stopping at the first difference.
+    a_stat/b_stat may be passed when already known to avoid re-stat'ing.
+    """
+    sa = a_stat if a_stat is not None else a.stat()
+    sb = b_stat if b_stat is not None else b.stat()
+    if os.path.samestat(sa, sb):
+        return True  # same inode: hardlink, or a case-insensitive filesystem alias
     if sa.st_size != sb.st_size:
         return False
-    return sha256_digest(a) == sha256_digest(b)
+    if _quick_unequal(a, b, sa.st_size):
+        return False
+    if sa.st_size <= 2 * QUICK_CMP_BLOCK:
+        return True  # head and tail blocks covered the whole file
+    if a_digest is not None:
+        return a_digest == digest_blake3(b, size=sb.st_size)
+    # No WILLNEED: the compare stops at the first differing block, so don't queue whole files.
+    with _open_sequential(a, prefetch=False) as fa, _open_sequential(b, prefetch=False) as fb:
+        while True:
+            ba = _read_block(fa, SAME_BYTES_BLOCK)
+            if ba != _read_block(fb, SAME_BYTES_BLOCK):
+                return False
+            if not ba:
+                return True
+
+
+def _suffix_start(stem: str) -> int:
+    """Index of the "__" that SUFFIX_RE would split stem at, or -1; regex-free for the hot path."""
+    # The suffix charset includes "_", so it suffices to check the last "__" that leaves >= 4 chars.
+    i = stem.rfind("__", 0, max(0, len(stem) - 4))
+    if i >= 0 and all(c in _SUFFIX_CHARS for c in stem[i + 2 :]):
+        return i
+    return -1
+
+
+def _has_suffix(stem: str) -> bool:
+    """Regex-free equivalent of bool(SUFFIX_RE.match(stem))."""
+    return _suffix_start(stem) >= 0
+
+
+def _scan_dir(d: str) -> Tuple[list, list]:
+    """(subdirectory paths, regular-file entries) of d; both empty if d cannot be listed."""
+    dirs, files = [], []
+    try:
+        with os.scandir(d) as it:
+            entries = list(it)
+    except OSError:
+        return dirs, files
+    for e in entries:
+        # Without d_type (some network filesystems) these checks stat, so they belong on the worker.
+        if e.is_dir(follow_symlinks=False):
+            dirs.append(e.path)
+        elif e.is_file(follow_symlinks=False):
+            files.append(e)
+    return dirs, files
+
+
+def iter_entries(root: Path, workers: int = 1) -> Iterator[os.DirEntry]:
+    """
+    Yield os.DirEntry for every regular file under root (iterative DFS over os.scandir).
+    Entries carry cached is_file()/stat() results and a ready-made string .path.
+    Each directory is listed fully before its entries are yielded, and its files are
+    yielded together, so renames by the caller are not re-seen. Symlinks are not
+    followed; unreadable directories are skipped, as with os.walk.
+    With workers > 1, up to 2*workers directories are listed ahead on a thread pool
+    so per-directory latency (e.g. on NFS/SMB) overlaps; directory order then varies.
+    """
+    stack = [os.fspath(root)]
+    if workers <= 1:
+        while stack:
+            dirs, files = _scan_dir(stack.pop())
+            stack.extend(dirs)
+            yield from files
+        return
+
+    inflight = set()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        while stack or inflight:
+            while stack and len(inflight) < 2 * workers:
+                inflight.add(ex.submit(_scan_dir, stack.pop()))
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                dirs, files = fut.result()
+                stack.extend(dirs)
+                yield from files
 
 
 def iter_files(root: Path):
-    for dirpath, _, filenames in os.walk(root):
-        for name in filenames:
-            yield Path(dirpath) / name
+    for e in iter_entries(root):
+        yield Path(e.path)
+
+
+def iter_digests(
+    items: Iterable[Tuple[Any, bool]],
+    jobs: int = 1,
+    digest: Callable[[Any], bytes] = digest_blake3,
+) -> Iterator[Tuple[Any, Optional[bytes]]]:
+    """
+    Yield (item, digest(item)) for each (item, want_digest) pair, in input order.
+    Items with want_digest False are passed through with digest None.
+    With jobs > 1, up to 2*jobs items are hashed ahead on a thread pool
+    (BLAKE3 releases the GIL, so reads and hashing overlap across files).
+    """
+    if jobs <= 1:
+        for item, want in items:
+            yield item, (digest(item) if want else None)
+        return
+
+    max_inflight = 2 * jobs
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=jobs) as ex:
+        for item, want in items:
+            pending.append((item, ex.submit(digest, item) if want else None))
+            if len(pending) >= max_inflight:
+                done, fut = pending.popleft()
+                yield done, (fut.result() if fut is not None else None)
+        while pending:
+            done, fut = pending.popleft()
+            yield done, (fut.result() if fut is not None else None)
 
 
-def propose_dst_apply(src: Path, digest: bytes, base_chars: int) -> Tuple[Optional[Path], str]:
+def hash_all(root: Path, workers: Optional[int] = None) -> Iterator[Tuple[Path, bytes]]:
     """
-    Return (dst, suffix_used). If dst is None, caller should skip (already suffixed or duplicate).
+    Yield (path, digest) for every regular file under root, in completion order.
+    The directory walk continues while up to 2*workers files are hashed on a thread pool
+    (default: one worker per CPU).
+    """
+    workers = workers or os.cpu_count() or 1
+    max_inflight = 2 * workers
+    futs = {}
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for e in iter_entries(root, workers):
+            p = Path(e.path)
+            futs[ex.submit(digest_blake3, p)] = p
+            if len(futs) >= max_inflight:
+                done, _ = wait(futs, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield futs.pop(fut), fut.result()
+        for fut in as_completed(futs):
+            yield futs[fut], fut.result()
+
+
+def _digest_small(file_path: Path) -> bytes:
+    # One open and one read for files below MMAP_HASH_MIN_SIZE (no stat); larger files
+    # are handed to digest_blake3.
+    with open(file_path, "rb") as f:
+        data = f.read(MMAP_HASH_MIN_SIZE)
+    if len(data) < MMAP_HASH_MIN_SIZE:
+        return blake3(data).digest()
+    return digest_blake3(file_path)
+
+
+def digest_many(paths: Iterable[Path], workers: Optional[int] = None) -> Dict[Path, bytes]:
+    """
+    BLAKE3 digests of many files (e.g. a directory of .aae/.xmp sidecars), hashed on a
+    thread pool (default: one worker per CPU). Small files are read whole and hashed in
+    a single call, so per-file overhead rather than the chunked loop dominates.
+    """
+    paths = list(paths)
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(paths) <= 1:
+        return {p: _digest_small(p) for p in paths}
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        return dict(zip(paths, ex.map(_digest_small, paths)))
+
+
+def _fold_name(name: str) -> str:
+    """Case- and normalization-folded file name, as compared by case-insensitive volumes (APFS/HFS+, NTFS)."""
+    return unicodedata.normalize("NFD", name).casefold()
+
+
+def propose_dst_apply(
+    src: Path,
+    digest: bytes,
+    base_chars: int,
+    src_stat: Optional[os.stat_result] = None,
+    existing: Optional[AbstractSet[str]] = None,
+) -> Tuple[Optional[Path], str]:
+    """
+    Return (dst, suffix_used). If dst is None, caller should skip (duplicate).
     If collision with different content, suffix length is extended deterministically.
+    Callers must skip already-suffixed stems (see _has_suffix) before hashing and calling this.
+    src_stat (e.g. a cached DirEntry.stat()) saves re-stat'ing src on collisions.
+    existing, the names currently in src's directory folded with _fold_name, turns the
+    per-candidate existence check into a set lookup; dst is only stat'ed when its folded
+    name is taken (on a case-sensitive volume that may be a false positive costing one stat).
     """
     stem = src.stem
-    if SUFFIX_RE.match(stem):
-        return None, ""
-
+    full_b64 = b64url_no_pad(digest)
     n = base_chars
     while True:
-        sfx = suffix_from_digest(digest, n)
+        sfx = full_b64[:n]
         dst = src.with_name(f"{stem}__{sfx}{src.suffix}")
-        if not dst.exists():
+        if existing is not None and _fold_name(dst.name) not in existing:
+            return dst, sfx
+        try:
+            dst_stat = dst.stat()  # one stat doubles as the existence check
+        except FileNotFoundError:
             return dst, sfx
-        if same_bytes(src, dst):
+        if src_stat is None:
+            src_stat = src.stat()
+        if dst_stat.st_size == src_stat.st_size and same_bytes(src, dst, digest, src_stat, dst_stat):
             return None, ""  # treat as duplicate
         n += 1
 
 
+def rename_noreplace(src: str, dst: str) -> None:
+    """
+    Rename src to dst, raising FileExistsError rather than replacing a dst that exists
+    at the time of the check. The check and the rename are separate steps, so this is not
+    race-free against another process creating dst in between; the rename itself is atomic.
+    For renames made some time after dst was checked (the CLI's apply-mode rename worker).
+    """
+    if os.path.lexists(dst):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+    os.rename(src, dst)
+
+
 def parse_suffix(stem: str) -> Optional[Tuple[str, str]]:
-    m = SUFFIX_RE.match(stem)
-    if not m:
+    i = _suffix_start(stem)
+    if i < 0:
         return None
-    return m.group("stem"), stem[len(m.group("stem")) + 2 :]  # after "__"
+    return stem[:i], stem[i + 2 :]  # after "__"
 
 
 def verify_suffix_matches_digest(suffix: str, digest: bytes, base_chars: int) -> bool:
@@ -101,8 +482,8 @@ def verify_suffix_matches_digest(suffix: str, digest: bytes, base_chars: int) ->
     """
     if len(suffix) < base_chars:
         return False
-    expected = suffix_from_digest(digest, len(suffix))
-    return suffix == expected
+    # One encode of the full digest, then a C-level prefix compare (base64 is prefix-stable).
+    return b64url_no_pad(digest).startswith(suffix)
 
 
 def find_noncolliding_strip_dst(dirpath: Path, stem: str, ext: str, policy: str) -> Optional[Path]:
@@ -1,52 +1,204 @@
-from pathlib import Path
+import json
+from types import SimpleNamespace
 
-from rename_to_avoid_collision import cli
+import pytest
+
+from rename_to_avoid_collision import cli, core
 
 HELLO_B3_HEX = "ea8f163db38682925e4491c5e58d4bb3506ef8c14eb78a86e908c5624a67200f"
 
 
-class FakePath:
+class FakeEntry:
+    """Minimal os.DirEntry stand-in for a file that does not exist on disk."""
+
     def __init__(self, name: str):
-        self._name = name
-        p = Path(name)
-        self._suffix = p.suffix
-        self._stem = p.stem
-        self._parent = Path("/fake")
+        self.name = name
+        self.path = f"/fake/{name}"
 
-    def is_file(self) -> bool:
-        return True
+    def stat(self, follow_symlinks: bool = True):
+        return SimpleNamespace(st_size=5, st_mtime=0)
 
-    @property
-    def suffix(self) -> str:
-        return self._suffix
 
-    @property
-    def stem(self) -> str:
-        return self._stem
+def test_cli_strip_verify_fail_emits_count(monkeypatch, capsys):
+    fake = FakeEntry("img__6o8WPa.heic")
 
-    @property
-    def parent(self) -> Path:
-        return self._parent
+    monkeypatch.setattr(cli, "iter_entries", lambda root, workers=1: [fake])
+    monkeypatch.setattr(cli, "digest_blake3", lambda path, size=None: bytes.fromhex(HELLO_B3_HEX))
 
-    def with_name(self, new_name: str):
-        return FakePath(new_name)
+    code = cli.main(["/root", "--strip"])
 
-    def exists(self) -> bool:
-        return False
+    out = capsys.readouterr().out
 
-    def __str__(self) -> str:
-        return self._name
+    assert code == 0
+    assert "skipped_verify_fail=1" in out
 
 
-def test_cli_strip_verify_fail_emits_count(monkeypatch, capsys):
-    fake = FakePath("img__6o8WPa.heic")
+def test_cli_apply_parallel_matches_serial(tmp_path):
+    names = [f"IMG_{i:04d}.heic" for i in range(20)]
+    results = []
+    for jobs in ("1", "4"):
+        root = tmp_path / f"jobs{jobs}"
+        root.mkdir()
+        for i, name in enumerate(names):
+            (root / name).write_bytes(b"x" * i)
 
-    monkeypatch.setattr(cli, "iter_files", lambda root: [fake])
-    monkeypatch.setattr(cli, "digest_blake3", lambda path: bytes.fromhex(HELLO_B3_HEX))
+        code = cli.main([str(root), "--apply", "--quiet", "--jobs", jobs, "--log", str(tmp_path / f"log{jobs}.jsonl")])
 
-    code = cli.main(["/root", "--strip"])
+        assert code == 0
+        results.append(sorted(p.name for p in root.iterdir()))
+
+    assert results[0] == results[1]
+    assert all("__" in name for name in results[0])
+
+
+def test_cli_apply_log_is_jsonl_without_orjson(tmp_path, monkeypatch):
+    monkeypatch.setattr(cli, "orjson", None)
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "IMG_0001.heic").write_bytes(b"hello")
+    log = tmp_path / "log.jsonl"
+
+    code = cli.main([str(root), "--apply", "--quiet", "--log", str(log)])
+
+    assert code == 0
+    (rec,) = [json.loads(line) for line in log.read_text(encoding="utf-8").splitlines()]
+    assert rec["mode"] == "apply"
+    assert rec["new"] == str(root / "IMG_0001__6o8WPb.heic")
+    assert rec["size"] == 5
+
+
+def test_cli_apply_does_not_hash_already_suffixed(monkeypatch, capsys):
+    def fail_digest(path, size=None):
+        raise AssertionError(f"hashed {path}")
+
+    monkeypatch.setattr(cli, "iter_entries", lambda root, workers=1: [FakeEntry("img__6o8WPb.heic")])
+    monkeypatch.setattr(cli, "digest_blake3", fail_digest)
+
+    code = cli.main(["/root", "--jobs", "1"])
+
+    assert code == 0
+    assert "skipped_dupe_or_already=1" in capsys.readouterr().out
+
+
+def test_cli_apply_rename_worker_error_is_raised(tmp_path, monkeypatch):
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "IMG_0001.heic").write_bytes(b"hello")
+
+    def fail_rename(old, new):
+        raise PermissionError(old)
+
+    monkeypatch.setattr(cli, "rename_noreplace", fail_rename)
+
+    with pytest.raises(PermissionError):
+        cli.main([str(root), "--apply", "--quiet", "--log", str(tmp_path / "log.jsonl")])
+
+    assert (root / "IMG_0001.heic").exists()
+    assert (tmp_path / "log.jsonl").read_bytes() == b""
+
+
+def test_cli_apply_existing_target_is_a_conflict_not_an_abort(tmp_path, monkeypatch, capsys):
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "IMG_0001.heic").write_bytes(b"hello")
+    (root / "IMG_0002.heic").write_bytes(b"world")
+    real = cli.rename_noreplace
+
+    def case_insensitive_hit(old, new):
+        # As on APFS, where img_0001__6o8WPb.heic would match but not be in the name set.
+        if old.endswith("IMG_0001.heic"):
+            raise FileExistsError(new)
+        real(old, new)
+
+    monkeypatch.setattr(cli, "rename_noreplace", case_insensitive_hit)
+
+    code = cli.main([str(root), "--apply", "--log", str(tmp_path / "log.jsonl")])
+
+    assert code == 0
+    captured = capsys.readouterr()
+    assert "renamed=1 " in captured.out and "conflicts=1" in captured.out
+    assert "[conflict] target exists" in captured.err
+    assert (root / "IMG_0001.heic").exists() and not (root / "IMG_0002.heic").exists()
+    assert len((tmp_path / "log.jsonl").read_bytes().splitlines()) == 1
+
+
+def test_cli_extension_filter_is_case_insensitive(tmp_path, capsys):
+    for name in ("a.heic", "b.HEIC", "c.Heic", "d.jpg", ".heic", "e.heic.txt"):
+        (tmp_path / name).write_bytes(name.encode())
+
+    code = cli.main([str(tmp_path), "--jobs", "1"])
 
     out = capsys.readouterr().out
+    assert code == 0
+    assert "considered=3" in out
+    assert "would_rename=3" in out
+    assert "skipped_not_target=3" in out
+
+
+def test_cli_apply_procs_splits_subdirectories(tmp_path):
+    root = tmp_path / "photos"
+    for d in ("2023", "2024", "2025"):
+        (root / d).mkdir(parents=True)
+        for i in range(3):
+            (root / d / f"IMG_{i}.heic").write_bytes(f"{d}-{i}".encode())
+    (root / "IMG_top.heic").write_bytes(b"top")
+    log = root / "rename-log.jsonl"
+
+    code = cli.main([str(root), "--apply", "--quiet", "--procs", "2", "--jobs", "1"])
 
     assert code == 0
-    assert "skipped_verify_fail=1" in out
+    recs = [json.loads(line) for line in log.read_text(encoding="utf-8").splitlines()]
+    assert len(recs) == 10
+    assert len({r["run_id"] for r in recs}) == 1
+    top_files = sorted(p.name for p in root.iterdir() if p.is_file())
+    assert top_files[1] == "rename-log.jsonl" and top_files[0].startswith("IMG_top__")  # worker logs folded in
+    assert all("__" in p.name for p in root.glob("*/*.heic"))
+
+
+def test_cli_strip_apply_logs_size_and_restores_name(tmp_path, monkeypatch):
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "IMG_0001__6o8WPb.heic").write_bytes(b"hello")
+    log = tmp_path / "log.jsonl"
+    # Strip mode has already stat'ed the target; it renames without a second existence check.
+    monkeypatch.setattr(cli, "rename_noreplace", lambda old, new: pytest.fail("re-checked target"))
+
+    code = cli.main([str(root), "--strip", "--apply", "--quiet", "--log", str(log)])
+
+    assert code == 0
+    assert (root / "IMG_0001.heic").read_bytes() == b"hello"
+    (rec,) = [json.loads(line) for line in log.read_text(encoding="utf-8").splitlines()]
+    assert rec["mode"] == "strip"
+    assert rec["suffix_removed"] == "6o8WPb"
+    assert rec["size"] == 5
+
+
+def test_cli_strip_existing_target_duplicate_and_conflict(tmp_path, capsys):
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "a__6o8WPb.heic").write_bytes(b"hello")
+    (root / "a.heic").write_bytes(b"hello")
+    (root / "b__6o8WPb.heic").write_bytes(b"hello")
+    (root / "b.heic").write_bytes(b"other")
+
+    code = cli.main([str(root), "--strip", "--apply", "--log", str(tmp_path / "log.jsonl")])
+
+    out = capsys.readouterr().out
+    assert code == 0
+    assert "skipped_dupe_or_already=3" in out  # a.heic and b.heic are unsuffixed; a__ is a duplicate
+    assert "conflicts=1" in out
+    assert (root / "b.heic").read_bytes() == b"other"
+
+
+def test_cli_cache_skips_rehash_on_strip(tmp_path, monkeypatch):
+    root = tmp_path / "photos"
+    root.mkdir()
+    (root / "IMG_0001.heic").write_bytes(b"hello")
+    cache = str(tmp_path / "digests.db")
+    assert cli.main([str(root), "--apply", "--quiet", "--cache", cache, "--log", str(tmp_path / "log.jsonl")]) == 0
+
+    monkeypatch.setattr(core, "digest_blake3", lambda *a, **kw: pytest.fail("re-hashed a cached file"))
+    code = cli.main([str(root), "--strip", "--apply", "--quiet", "--cache", cache, "--log", str(tmp_path / "log.jsonl")])
+
+    assert code == 0
+    assert [p.name for p in root.iterdir()] == ["IMG_0001.heic"]
@@ -1,5 +1,11 @@
+import base64
 import io
+import os
 from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from blake3 import blake3
 
 from rename_to_avoid_collision import core
 
@@ -7,25 +13,30 @@ HELLO_B3_HEX = "ea8f163db38682925e4491c5e58d4bb3506ef8c14eb78a86e908c5624a67200f
 HELLO_SFX6 = "6o8WPb"  # derived from b3sum("hello") digest prefix
 
 
-def test_digest_blake3_known_content(monkeypatch):
-    data = b"hello"
+def test_digest_blake3_known_content(tmp_path):
+    p = tmp_path / "hello.bin"
+    p.write_bytes(b"hello")
 
-    def fake_open(self, mode="rb"):
-        assert mode == "rb"
-        return io.BytesIO(data)
+    digest = core.digest_blake3(p)
 
-    monkeypatch.setattr(Path, "open", fake_open)
+    assert digest.hex() == HELLO_B3_HEX
 
-    digest = core.digest_blake3(Path("ignored"))
 
-    assert digest.hex() == HELLO_B3_HEX
+def test_digest_blake3_large_file_matches_streaming(tmp_path, monkeypatch):
+    data = bytes(range(256)) * (3 * core.MT_HASH_MIN_SIZE // 256 + 1)
+    p = tmp_path / "big.mov"
+    p.write_bytes(data)
 
+    assert core.digest_blake3(p) == blake3(data).digest()
 
-def test_propose_dst_apply_uses_expected_suffix(monkeypatch):
-    digest = bytes.fromhex(HELLO_B3_HEX)
-    src = Path("IMG_0001.jpg")
+    monkeypatch.setattr(core, "_HAS_UPDATE_MMAP", False)  # older blake3 wheels
 
-    monkeypatch.setattr(Path, "exists", lambda self: False)
+    assert core.digest_blake3(p) == blake3(data).digest()
+
+
+def test_propose_dst_apply_uses_expected_suffix(tmp_path):
+    digest = bytes.fromhex(HELLO_B3_HEX)
+    src = tmp_path / "IMG_0001.jpg"
 
     dst, sfx = core.propose_dst_apply(src, digest, 6)
 
@@ -39,3 +50,361 @@ def test_verify_suffix_matches_digest_true_and_false():
 
     assert core.verify_suffix_matches_digest(HELLO_SFX6, digest, 6)
     assert not core.verify_suffix_matches_digest("6o8WPa", digest, 6)
+
+
+def test_same_bytes_uses_head_tail_and_digest(tmp_path, monkeypatch):
+    block = b"h" * core.QUICK_CMP_BLOCK
+    a = tmp_path / "a.heic"
+    b = tmp_path / "b.heic"
+    c = tmp_path / "c.heic"
+    d = tmp_path / "d.heic"
+    a.write_bytes(block + b"middle-1" + block)
+    b.write_bytes(block + b"middle-1" + block)
+    c.write_bytes(block + b"middle-2" + block)
+    d.write_bytes(block + b"middle-1" + block[:-1] + b"t")
+
+    assert core.same_bytes(a, b)
+    assert core.same_bytes(a, b, core.digest_blake3(a))
+    assert not core.same_bytes(a, c)
+    assert not core.same_bytes(a, d)
+    assert core._quick_unequal(a, d, a.stat().st_size)
+    assert not core.same_bytes(a, b, b"\0" * 32)  # a_digest is trusted, a is not re-hashed
+
+    sa, sb = a.stat(), b.stat()
+    monkeypatch.setattr(Path, "stat", lambda self, **kw: pytest.fail(f"re-stat'ed {self.name}"))
+    assert core.same_bytes(a, b, core.digest_blake3(a, size=sa.st_size), sa, sb)
+
+
+def test_iter_entries_yields_nested_files_only(tmp_path):
+    (tmp_path / "sub" / "deeper").mkdir(parents=True)
+    for rel in ("a.heic", "sub/b.jpg", "sub/deeper/c.mov"):
+        (tmp_path / rel).write_bytes(b"x")
+    (tmp_path / "sub" / "link.heic").symlink_to(tmp_path / "a.heic")
+
+    entries = list(core.iter_entries(tmp_path))
+
+    assert sorted(e.name for e in entries) == ["a.heic", "b.jpg", "c.mov"]
+    assert sorted(core.iter_files(tmp_path)) == sorted(Path(e.path) for e in entries)
+
+
+def test_iter_entries_parallel_keeps_directories_contiguous(tmp_path):
+    for d in range(6):
+        for sub in range(3):
+            (tmp_path / f"d{d}" / f"s{sub}").mkdir(parents=True)
+            for i in range(4):
+                (tmp_path / f"d{d}" / f"s{sub}" / f"IMG_{i}.heic").write_bytes(b"x")
+        (tmp_path / f"d{d}" / "top.jpg").write_bytes(b"x")
+
+    serial = [e.path for e in core.iter_entries(tmp_path)]
+    parallel = [e.path for e in core.iter_entries(tmp_path, workers=4)]
+
+    assert sorted(parallel) == sorted(serial) and len(serial) == 6 * 13
+    parents = [os.path.dirname(p) for p in parallel]
+    runs = [d for i, d in enumerate(parents) if i == 0 or parents[i - 1] != d]
+    assert len(runs) == len(set(parents))  # each directory's files arrive together
+
+
+def test_has_suffix_and_parse_suffix_match_regex():
+    stems = [
+        "IMG_0001", "IMG_0001__6o8WPb", "IMG__abc", "IMG__abcd", "x__ab__cd", "x__ab.cd",
+        "a___abcd", "___", "____", "______", "__abcd", "IMG__ab cd", "IMG__6o8WPb-_x", "",
+    ]
+    for stem in stems:
+        m = core.SUFFIX_RE.match(stem)
+        assert core._has_suffix(stem) == bool(m), stem
+        assert core.parse_suffix(stem) == ((m.group("stem"), m.group(2)) if m else None), stem
+
+
+def test_b64url_no_pad_stdlib_fallback(monkeypatch):
+    digest = bytes.fromhex(HELLO_B3_HEX)
+    fast = core.b64url_no_pad(digest)
+
+    monkeypatch.setattr(core, "_urlsafe_b64encode", base64.urlsafe_b64encode)
+
+    assert core.b64url_no_pad(digest) == fast
+    assert fast.startswith(HELLO_SFX6) and "=" not in fast
+
+
+def test_suffix_from_digest_is_prefix_of_full_encoding():
+    digest = bytes.fromhex(HELLO_B3_HEX)
+    for n in range(1, 44):
+        n_bytes = (3 * n + 3) // 4
+        assert core.suffix_from_digest(digest, n) == core.b64url_no_pad(digest[:n_bytes])[:n]
+
+
+def test_digest_blake3_mmap_sizes_match_streaming(tmp_path):
+    for size in (core.MMAP_HASH_MIN_SIZE - 1, core.MMAP_HASH_MIN_SIZE, core.MT_HASH_MIN_SIZE - 1):
+        data = bytes(i % 251 for i in range(size))
+        p = tmp_path / f"f{size}.heic"
+        p.write_bytes(data)
+
+        assert core.digest_blake3(p) == blake3(data).digest(), size
+
+
+def test_digest_blake3_streams_unbuffered_in_chunks(tmp_path, monkeypatch):
+    data = bytes(i % 251 for i in range(2500))
+    p = tmp_path / "IMG_0001.aae"
+    p.write_bytes(data)
+
+    with core._open_sequential(p) as f:
+        assert isinstance(f, io.FileIO)
+    assert core.digest_blake3(p, chunk_size=1000) == blake3(data).digest()
+    monkeypatch.setattr(core, "HASH_CHUNK_SIZE", 1000)
+    assert core.digest_blake3(p) == blake3(data).digest()
+    # The buffer is sized from the hint, but the loop still reads to EOF if the hint is stale.
+    assert core.digest_blake3(p, size=10) == blake3(data).digest()
+
+
+def test_verify_suffix_matches_digest_extended_and_short():
+    digest = bytes.fromhex(HELLO_B3_HEX)
+    full = core.b64url_no_pad(digest)
+
+    assert core.verify_suffix_matches_digest(full[:9], digest, 6)
+    assert core.verify_suffix_matches_digest(full, digest, 6)
+    assert not core.verify_suffix_matches_digest(full[:5], digest, 6)
+    assert not core.verify_suffix_matches_digest(full + "A", digest, 6)
+
+
+def test_digest_blake3_multithreads_only_large_files(tmp_path, monkeypatch):
+    seen = []
+
+    def spy_blake3(*args, max_threads=1, **kwargs):
+        seen.append(max_threads)
+        return blake3(*args, max_threads=max_threads, **kwargs)
+
+    spy_blake3.AUTO = blake3.AUTO
+    monkeypatch.setattr(core, "blake3", spy_blake3)
+    small = tmp_path / "small.aae"
+    large = tmp_path / "large.mov"
+    small.write_bytes(b"x" * 1000)
+    large.write_bytes(b"x" * core.MT_HASH_MIN_SIZE)
+
+    core.digest_blake3(small)
+    core.digest_blake3(large)
+
+    assert seen == [1, blake3.AUTO]
+
+
+def test_hash_all_matches_digest_blake3(tmp_path):
+    (tmp_path / "sub").mkdir()
+    paths = [tmp_path / f"IMG_{i}.heic" for i in range(5)] + [tmp_path / "sub" / "IMG_x.mov"]
+    for i, p in enumerate(paths):
+        p.write_bytes(b"y" * (i * 1000))
+
+    got = dict(core.hash_all(tmp_path, workers=2))
+
+    assert got == {p: core.digest_blake3(p) for p in paths}
+
+
+def test_propose_dst_apply_collision_paths(tmp_path, monkeypatch):
+    data = b"hello" * 4000  # larger than the head/tail blocks, so same_bytes must hash
+    src = tmp_path / "IMG_0001.jpg"
+    src.write_bytes(data)
+    digest = core.digest_blake3(src)
+    full = core.b64url_no_pad(digest)
+    taken = tmp_path / f"IMG_0001__{full[:6]}.jpg"
+
+    taken.write_bytes(data)
+    hashed = []
+    real_digest = core.digest_blake3
+    monkeypatch.setattr(core, "digest_blake3", lambda p, *a, **kw: hashed.append(p) or real_digest(p, *a, **kw))
+
+    assert core.propose_dst_apply(src, digest, 6) == (None, "")  # duplicate
+    assert hashed == [taken]  # the known source digest is reused
+
+    taken.write_bytes(data[:10000] + b"X" + data[10001:])
+    dst, sfx = core.propose_dst_apply(src, digest, 6)
+
+    assert sfx == full[:7]
+    assert dst == tmp_path / f"IMG_0001__{sfx}.jpg"
+
+
+def test_propose_dst_apply_size_mismatch_skips_content_compare(tmp_path, monkeypatch):
+    src = tmp_path / "IMG_0001.jpg"
+    src.write_bytes(b"hello")
+    digest = bytes.fromhex(HELLO_B3_HEX)
+    (tmp_path / f"IMG_0001__{HELLO_SFX6}.jpg").write_bytes(b"longer content")
+
+    def fail_same_bytes(*args):
+        raise AssertionError("same_bytes called despite size mismatch")
+
+    monkeypatch.setattr(core, "same_bytes", fail_same_bytes)
+
+    dst, sfx = core.propose_dst_apply(src, digest, 6, src_stat=src.stat())
+
+    assert len(sfx) == 7 and sfx.startswith(HELLO_SFX6)
+
+
+def test_same_bytes_hardlink_short_circuits(tmp_path, monkeypatch):
+    a = tmp_path / "a.heic"
+    a.write_bytes(b"z" * (4 * core.QUICK_CMP_BLOCK))
+    b = tmp_path / "b.heic"
+    os.link(a, b)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("content was read")
+
+    monkeypatch.setattr(core, "_quick_unequal", fail)
+    monkeypatch.setattr(core, "digest_blake3", fail)
+
+    assert core.same_bytes(a, b)
+
+
+def test_same_bytes_without_digest_compares_in_lockstep(tmp_path, monkeypatch):
+    data = bytes(i % 253 for i in range(3 * core.SAME_BYTES_BLOCK))
+    a = tmp_path / "a.mov"
+    b = tmp_path / "b.mov"
+    c = tmp_path / "c.mov"
+    a.write_bytes(data)
+    b.write_bytes(data)
+    c.write_bytes(data[:100000] + b"\xff" + data[100001:])
+
+    def fail(*args, **kwargs):
+        raise AssertionError("hashed without a known digest")
+
+    monkeypatch.setattr(core, "digest_blake3", fail)
+    hints = []
+    monkeypatch.setattr(core, "_fadvise", lambda fd, *names: hints.extend(names))
+
+    assert core.same_bytes(a, b)
+    assert not core.same_bytes(a, c)
+    assert hints and "POSIX_FADV_WILLNEED" not in hints  # may stop early: no whole-file prefetch
+
+
+def test_same_bytes_lockstep_tolerates_short_reads(tmp_path, monkeypatch):
+    data = bytes(i % 251 for i in range(3 * core.SAME_BYTES_BLOCK))
+    a, b = tmp_path / "a.mov", tmp_path / "b.mov"
+    a.write_bytes(data)
+    b.write_bytes(data)
+    real = core._open_sequential
+
+    class ShortReads:
+        # Unbuffered reads that return at most 1000 bytes, as on some network filesystems.
+        def __init__(self, f):
+            self.f = f
+
+        def read(self, n):
+            return self.f.read(min(n, 1000))
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.f.close()
+
+    monkeypatch.setattr(
+        core, "_open_sequential", lambda p, **kw: ShortReads(real(p, **kw)) if p == a else real(p, **kw)
+    )
+
+    assert core.same_bytes(a, b)
+
+
+def test_rename_noreplace_refuses_existing_dst(tmp_path):
+    src = tmp_path / "a.heic"
+    dst = tmp_path / "a__6o8WPb.heic"
+    src.write_bytes(b"src")
+    dst.write_bytes(b"dst")
+
+    with pytest.raises(FileExistsError):
+        core.rename_noreplace(str(src), str(dst))
+    assert src.read_bytes() == b"src" and dst.read_bytes() == b"dst"
+
+    dst.unlink()
+    core.rename_noreplace(str(src), str(dst))
+    assert not src.exists() and dst.read_bytes() == b"src"
+    assert dst.stat().st_nlink == 1  # a plain rename: no second name left behind
+
+    with pytest.raises(FileExistsError):
+        core.rename_noreplace(str(dst), str(dst))
+
+
+def test_propose_dst_apply_uses_existing_names(tmp_path, monkeypatch):
+    src = tmp_path / "IMG_0001.jpg"
+    src.write_bytes(b"hello")
+    digest = bytes.fromhex(HELLO_B3_HEX)
+    (tmp_path / f"IMG_0001__{HELLO_SFX6}.jpg").write_bytes(b"HELLO")
+
+    # The name set is trusted: a name missing from it is free without a stat.
+    dst, _ = core.propose_dst_apply(src, digest, 6, existing=set())
+    assert dst.name == f"IMG_0001__{HELLO_SFX6}.jpg"
+
+    names = {core._fold_name(n) for n in os.listdir(tmp_path)}
+    dst, sfx = core.propose_dst_apply(src, digest, 6, existing=names)
+    assert len(sfx) == 7 and core._fold_name(dst.name) not in names
+
+    # A case/normalization variant (same file on APFS) is not trusted as free: dst is stat'ed,
+    # which on this case-sensitive volume finds nothing.
+    assert core._fold_name("Cafe\u0301__AB.HEIC") == core._fold_name("caf\u00e9__ab.heic")
+    (tmp_path / f"IMG_0001__{HELLO_SFX6}.jpg").unlink()
+    variant = {core._fold_name(f"img_0001__{HELLO_SFX6.lower()}.JPG")}
+    stats = []
+    real_stat = Path.stat
+    monkeypatch.setattr(Path, "stat", lambda self, **kw: stats.append(self.name) or real_stat(self, **kw))
+    dst, sfx = core.propose_dst_apply(src, digest, 6, existing=variant)
+    assert sfx == HELLO_SFX6 and stats == [dst.name]
+
+
+def test_digest_cache_hits_survive_rename_and_miss_on_change(tmp_path, monkeypatch):
+    p = tmp_path / "IMG_0001.jpg"
+    p.write_bytes(b"hello")
+    calls = []
+    real = core.digest_blake3
+    monkeypatch.setattr(core, "digest_blake3", lambda path, **kw: calls.append(path) or real(path, **kw))
+
+    with core.DigestCache(tmp_path / "cache.db") as cache:
+        assert cache.cached_digest(p).hex() == HELLO_B3_HEX
+    moved = p.rename(tmp_path / "IMG_0001__6o8WPb.jpg")
+    with core.DigestCache(tmp_path / "cache.db") as cache:
+        assert cache.cached_digest(moved).hex() == HELLO_B3_HEX  # same inode/mtime/size: no re-hash
+        assert len(calls) == 1
+
+        os.utime(moved, ns=(0, 0))
+        assert cache.cached_digest(moved).hex() == HELLO_B3_HEX
+        assert len(calls) == 2
+
+
+def test_digest_cache_ignores_zero_inode_stats(tmp_path):
+    a, b = tmp_path / "IMG_0001.heic", tmp_path / "IMG_0002.heic"
+    a.write_bytes(b"hello")
+    b.write_bytes(b"world")
+    # What os.DirEntry.stat() reports on Windows: no file identity, same mtime and size.
+    st = SimpleNamespace(st_dev=0, st_ino=0, st_mtime_ns=1, st_size=5)
+
+    with core.DigestCache(tmp_path / "cache.db") as cache:
+        assert cache.cached_digest(a, st) == core.digest_blake3(a)
+        assert cache.cached_digest(b, st) == core.digest_blake3(b)
+        cache.put(st, b"x" * 32)
+        assert cache.get(st) is None
+
+
+def test_digest_cache_instances_share_one_database(tmp_path, monkeypatch):
+    # As with --procs: one connection per process, interleaved writes must not wait on each other.
+    monkeypatch.setattr(core.DigestCache, "COMMIT_EVERY", 2)
+    files = []
+    for i in range(5):
+        p = tmp_path / f"IMG_{i}.heic"
+        p.write_bytes(b"x" * i)
+        files.append(p)
+
+    a = core.DigestCache(tmp_path / "cache.db")
+    b = core.DigestCache(tmp_path / "cache.db")
+    a._db.execute("PRAGMA busy_timeout=100")
+    b._db.execute("PRAGMA busy_timeout=100")
+    for i, p in enumerate(files):
+        (a if i % 2 else b).cached_digest(p)
+    a.close()
+    b.close()
+
+    with core.DigestCache(tmp_path / "cache.db") as cache:
+        assert all(cache.get(p.stat()) == core.digest_blake3(p) for p in files)
+
+
+def test_digest_many_matches_digest_blake3(tmp_path):
+    paths = []
+    for i, size in enumerate([0, 5, core.MMAP_HASH_MIN_SIZE - 1, core.MMAP_HASH_MIN_SIZE, 3 * core.MMAP_HASH_MIN_SIZE]):
+        p = tmp_path / f"f{i}.xmp"
+        p.write_bytes(bytes(range(256)) * (size // 256) + b"z" * (size % 256))
+        paths.append(p)
+
+    for workers in (1, 4):
+        assert core.digest_many(paths, workers) == {p: core.digest_blake3(p) for p in paths}